@@ -7,6 +7,7 @@ Usage:
     ./build.py [build]
     ./build.py watch
     ./build.py serve [-p <port>] [-h <host>]
+    ./build.py clean
     ./build.py --help
     ./build.py --version
 
@@ -26,11 +27,17 @@ if sys.version_info < (3, 2):
 elif sys.version_info < (3, 4, 1):
     warn("This script may run incorrectly on versions of Python less than 3.4.1", RuntimeWarning)
 
-import time
 import os
+import threading
+import types
 import shutil
+import hashlib
+import re
+import marshal
+from itertools import repeat
+from functools import lru_cache, partial
+from concurrent.futures import ProcessPoolExecutor
 from os import path
-from distutils import dir_util # Weird place for a recursive directory copy...
 from docopt import docopt
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
@@ -38,8 +45,177 @@ import cinje # Template engine
 import markdown
 import frontmatter
 
+# Extensions can be given by name or as Extension instances (to set their
+# options), so they're identified by name or by class and options. This
+# has to be stable between runs and processes: it's used in cache keys.
+def _extension_key(ext):
+    if isinstance(ext, str):
+        return ext
+
+    def stable_repr(value):
+        if callable(value) and hasattr(value, "__qualname__"): # Eg. toc's slugify
+            return "{}.{}".format(value.__module__, value.__qualname__)
+        return repr(value)
+
+    options = sorted((k, stable_repr(v)) for k, v in ext.getConfigs().items())
+    return "{}.{}{}".format(type(ext).__module__, type(ext).__qualname__, options)
+
+def _extensions_key(extensions):
+    return repr(sorted(_extension_key(ext) for ext in extensions))
+
+# Registering extensions is the expensive part of creating a Markdown
+# instance, so each process keeps one per set of extensions
+_translators = {}
+
+def _translator(extensions):
+    key = _extensions_key(extensions)
+    if key not in _translators:
+        # Sorted so extensions are registered in the same order everywhere
+        _translators[key] = markdown.Markdown(extensions=sorted(extensions, key=_extension_key))
+    return _translators[key]
+
+# Most front matter is just a few "key: value" lines, which can be parsed
+# much faster than by handing them to PyYAML
+_FAST_FM = re.compile(rb"---\n((?:[A-Za-z_][A-Za-z0-9_]*: [^\n]*\n)+)---\n")
+_FAST_INT = re.compile(r"0|-?[1-9][0-9]*")
+_FAST_STR = re.compile(r"[A-Za-z][A-Za-z0-9 _.,!?'()/&+-]*(?<! )")
+_YAML_WORDS = {"yes", "no", "true", "false", "on", "off", "null"} # Not strings in YAML
+
+def _load_frontmatter(data):
+    match = _FAST_FM.match(data)
+    if match:
+        meta = {}
+        for line in match.group(1).decode("utf-8").splitlines():
+            key, value = line.split(": ", 1)
+            if key.lower() in _YAML_WORDS:
+                break
+            elif _FAST_INT.fullmatch(value):
+                meta[key] = int(value)
+            elif _FAST_STR.fullmatch(value) and value.lower() not in _YAML_WORDS:
+                meta[key] = value
+            else: # YAML might read this differently
+                break
+        else:
+            return meta, data[match.end():].decode("utf-8").strip()
+
+    page = frontmatter.loads(data.decode("utf-8"))
+    return page.metadata, page.content
+
+# Filters are compiled with numba where it's available, otherwise they
+# just run as normal Python. Filters that were already compiled (ie.
+# numba dispatchers, which have a py_func) are left alone.
+@lru_cache(maxsize=8)
+def _compile_filters(filters):
+    try:
+        from numba import njit
+    except ImportError:
+        return filters
+
+    return tuple(f if hasattr(f, "py_func") else njit(cache=True)(f) for f in filters)
+
+# Filters' code is part of the conversion cache key, along with the values
+# of the globals and closure variables it uses (eg. a lookup table), so that
+# editing any of them invalidates cached pages. Functions those refer to are
+# only covered by their own code.
+@lru_cache(maxsize=8)
+def _filters_key(filters):
+    def stable_repr(value):
+        value = getattr(value, "py_func", value) # Already compiled by numba
+        if hasattr(value, "__code__"):
+            return repr(marshal.dumps(value.__code__))
+        if isinstance(value, types.ModuleType):
+            return value.__name__
+        return repr(value)
+
+    key = []
+    for f in filters:
+        f = getattr(f, "py_func", f)
+        if not hasattr(f, "__code__"):
+            raise TypeError("numba_filters must be functions, not {!r}".format(f))
+
+        names = [(n, stable_repr(f.__globals__[n])) for n in f.__code__.co_names if n in f.__globals__]
+        cells = [stable_repr(c.cell_contents) for c in f.__closure__ or ()]
+        key.append((marshal.dumps(f.__code__), names, cells))
+
+    return repr(key).encode()
+
+def apply_filters(text, filters=None):
+    """Runs Markdown text through filters, which take and return uint8
+    arrays of UTF-8 encoded text. Defaults to config.numba_filters."""
+
+    if filters is None:
+        filters = tuple(config.numba_filters)
+
+    if not filters:
+        return text
+
+    import numpy
+    data = numpy.frombuffer(bytearray(text.encode("utf-8")), numpy.uint8)
+    for f in _compile_filters(filters):
+        data = f(data)
+
+    return data.tobytes().decode("utf-8")
+
+# Converted HTML depends on the Markdown version, and on the Pygments version
+# when code is highlighted, so these are part of the cache key
+@lru_cache(maxsize=8)
+def _versions(extensions_key):
+    versions = [getattr(markdown, "__version__", None) or markdown.version]
+    if "codehilite" in extensions_key:
+        import pygments
+        versions.append(pygments.__version__)
+
+    return repr(versions).encode()
+
+# This has to be a top-level function so it can be sent to worker processes.
+# Workers already have a Markdown instance for extensions_key; see
+# _init_worker.
+def _render_page(fn, prefix, extensions_key, cache, md=None, filters=()):
+    if not md:
+        md = _translators[extensions_key]
+
+    # The whole file is read in one go, so skip the buffering layer;
+    # readall() sizes its buffer from the file's size up front
+    with open(fn, "rb", buffering=0) as f:
+        meta, content = _load_frontmatter(f.readall())
+
+    # Convert the markdown to HTML, reusing the cached conversion if the
+    # same source has been converted with the same extensions, filters and
+    # library versions before
+    key_data = content.encode() + extensions_key.encode() + _versions(extensions_key)
+    if filters:
+        key_data += _filters_key(filters)
+    key = hashlib.blake2b(key_data, digest_size=16).hexdigest()
+    cache_path = path.join(cache, key + ".html")
+    if path.isfile(cache_path):
+        with open(cache_path, encoding="utf-8") as f:
+            body = f.read()
+    else:
+        body = md.convert(apply_filters(content, filters))
+        # Always reset, even without stateful extensions: Markdown itself
+        # keeps link references and stashed HTML between documents
+        md.reset()
+
+        # Write to a temporary file first so an interrupted build can't
+        # leave a truncated cache entry behind. The PID keeps workers
+        # converting identical pages from clobbering each other. The cache
+        # directory is (re)created here in case it was cleaned while
+        # watching.
+        os.makedirs(cache, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp_path, cache_path)
+
+    # Create the output path, which is absolute (from the site's root) and
+    # always uses forward slashes since it's also used in links
+    rel = path.splitext(path.relpath(fn, prefix))[0]
+    out_path = "/" + rel.replace(os.sep, "/") + ".html"
+
+    return out_path, body, meta
+
 class Page:
-    def __init__(self, fn, prefix=None, children=[], md=None):
+    def __init__(self, fn, prefix=None, children=[], md=None, rendered=None):
         if not prefix:
             prefix = config.dirs.content
 
@@ -49,17 +225,18 @@ class Page:
         if hasattr(fn, "path"): # Handle DirEntry objects
             fn = fn.path
 
-        page = frontmatter.load(fn)
-        self._meta = page.metadata
-
-        # Convert the markdown to HTML
-        self.body = md.convert(page.content)
-        md.reset() # Resetting improves speed, apparently
+        # Pages converted elsewhere (eg. by read_pages) are passed in as
+        # the result of _render_page
+        if not rendered:
+            extensions_key = _extensions_key(config.extensions)
+            rendered = _render_page(fn, prefix, extensions_key, config.dirs.cache, md,
+                    tuple(config.numba_filters))
 
-        # Create the output path
-        self.path = fn.lstrip(prefix).rstrip("md") + "html"
+        self.source = fn
+        self.path, self.body, self._meta = rendered
 
         self.children = children
+        self.parent = None
 
     def __contains__(self, name):
         return name in self._meta or name in dir(self)
@@ -73,63 +250,159 @@ def read_pages(content=None):
 
     content = path.normcase(path.normpath(content))
 
-    def read_subdir(d):
+    # Plan out the page tree first as (filename, children) pairs, so the
+    # Markdown conversion can be done in parallel
+    def plan_subdir(d):
         assert d.is_dir()
 
-        index_path = path.join(d.path, "index.md")
-        if not path.isfile(index_path):
-            print(d.path + " does not contain index.md; skipping")
-
+        # Everything is decided from the DirEntry objects, which avoids
+        # extra stat() calls on most platforms
+        index_path = None
         children = []
         for de in os.scandir(d.path):
             if de.is_dir():
-                children.extend(read_subdir(de))
-                continue
-
-            if de.name != "index.md":
-                children.append(Page(de, content))
+                children.extend(plan_subdir(de))
+            elif de.name == "index.md":
+                index_path = de.path
+            elif de.name.endswith(".md"):
+                children.append((de.path, []))
+            else:
+                print(de.path + ": Not a markdown file")
+
+        if not index_path:
+            print(d.path + " does not contain index.md; skipping")
+            return
 
-        yield Page(index_path, content, children)
+        yield index_path, children
 
+    plan = []
     for de in os.scandir(content):
         if de.is_dir():
-            yield from read_subdir(de)
+            plan.extend(plan_subdir(de))
             continue
 
         # Check if it's a markdown file
         if not de.name.endswith(".md"):
-            print(fn + ": Not a markdown file")
+            print(de.path + ": Not a markdown file")
             continue
 
-        yield Page(de, content)
+        plan.append((de.path, []))
+
+    def filenames(nodes):
+        for fn, children in nodes:
+            yield fn
+            yield from filenames(children)
+
+    fns = list(filenames(plan))
+    extensions_key = _extensions_key(config.extensions)
+    # Send pages to the workers in batches, so large sites don't pay for a
+    # round trip per page, while still giving each worker several batches
+    chunksize = max(1, len(fns) // ((os.cpu_count() or 1) * 4))
+    render_page = partial(_render_page, filters=tuple(config.numba_filters))
+    rendered = dict(zip(fns, executor.map(render_page, fns,
+        repeat(content), repeat(extensions_key), repeat(config.dirs.cache),
+        chunksize=chunksize)))
+
+    # Keep track of pages by source file so watch mode can rebuild
+    # individual pages
+    config._page_by_src = {}
+
+    def make_page(node):
+        fn, children = node
+        page = Page(fn, content, [make_page(c) for c in children], rendered=rendered[fn])
+        for child in page.children:
+            child.parent = page
+
+        config._page_by_src[path.abspath(fn)] = page
+        return page
+
+    for node in plan:
+        yield make_page(node)
+
+def reload_page(page, content=None):
+    if not content:
+        content = config.dirs.content
+
+    content = path.normcase(path.normpath(content))
+
+    extensions_key = _extensions_key(config.extensions)
+    page.path, page.body, page._meta = _render_page(page.source, content,
+            extensions_key, config.dirs.cache, markdown_translator,
+            tuple(config.numba_filters))
+
+def _flatten(pages):
+    for page in pages:
+        yield page
+        if page.children:
+            yield from _flatten(page.children)
+
+def save_page(page, output=None, created=None):
+    if not output:
+        output=config.dirs.output
+
+    # Can't use path.join because page.path is absolute
+    outpath = path.normpath(output + page.path)
+
+    # Create the parent directory if necessary. When saving many pages,
+    # created holds the directories known to exist, to save on syscalls.
+    outdir = path.dirname(outpath)
+    if created is None or outdir not in created:
+        os.makedirs(outdir, exist_ok=True)
+
+        if created is not None:
+            # makedirs creates every ancestor as well
+            while outdir and outdir not in created:
+                created.add(outdir)
+                if path.dirname(outdir) == outdir: # Reached the root
+                    break
+                outdir = path.dirname(outdir)
+
+    # Render the template with the Page object, writing chunks straight to
+    # the output file as the template produces them
+    with open(outpath, "w", encoding="utf-8", buffering=1 << 16) as f:
+        f.writelines(template.render(config, page))
 
 def save_pages(pages, output=None):
     if not output:
         output=config.dirs.output
 
-    for page in pages:
-        # Render the template with the Page object
-        out_html = "".join(template.render(config, page))
+    seen = set()
+    created = set()
+    for page in _flatten(pages):
+        if __debug__:
+            # Each page should only appear once in the tree
+            assert page not in seen, page.source + " would be saved twice"
+            seen.add(page)
 
-        # Can't use path.join because page.path is absolute
-        outpath = path.normpath(output + page.path)
+        save_page(page, output, created)
 
-        # Create the parent directory if necessary
-        outdir = path.dirname(outpath)
-        os.makedirs(outdir, exist_ok=True)
+def _sync_tree(src, dest):
+    os.makedirs(dest, exist_ok=True)
+    for de in os.scandir(src):
+        target = path.join(dest, de.name)
+        if de.is_dir():
+            _sync_tree(de.path, target)
+            continue
 
-        # Write the HTML to the output file
-        with open(outpath, "w") as f:
-            f.write(out_html)
+        # Skip files that haven't changed since they were last copied
+        st = de.stat()
+        try:
+            target_st = os.stat(target)
+            if target_st.st_mtime_ns == st.st_mtime_ns and target_st.st_size == st.st_size:
+                continue
 
-        # Recurse through tree
-        if page.children:
-            save_pages(page.children, output)
+            # The old copy may be read-only, now that modes are kept
+            os.unlink(target)
+        except FileNotFoundError:
+            pass
 
-def build(pages=None, output=None, assets=None):
-    if not pages:
-        pages = config.pages
+        # copyfile uses the fastest copy the platform has to offer, but only
+        # copies contents, so the mode and times are carried over separately
+        shutil.copyfile(de.path, target)
+        shutil.copymode(de.path, target)
+        os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
 
+def copy_assets(output=None, assets=None):
     if not output:
         output=config.dirs.output
 
@@ -146,21 +419,28 @@ def build(pages=None, output=None, assets=None):
     for src in assets:
         if path.isdir(src):
             dest = path.join(output, path.basename(src))
-            dir_util.copy_tree(src, dest, update=1)
+            _sync_tree(src, dest)
         else:
             shutil.copy(src, output)
 
-    save_pages(pages, output)
+def build(pages=None, output=None, assets=None):
+    if not pages:
+        pages = config.pages
 
-def init(opts):
-    global config, template, markdown_translator
+    if not output:
+        output=config.dirs.output
 
-    sys.path.insert(0, "") # Allow importing from the current directory
+    copy_assets(output, assets)
+    save_pages(pages, output)
 
-    import template # Yes, cinje is just that awesome
+def clean(cache=None):
+    if not cache:
+        cache = config.dirs.cache
+
+    shutil.rmtree(cache, ignore_errors=True)
 
-    # Configuration
-    import types
+# Configuration
+def _load_config():
     defaults = types.ModuleType("vsg.defaults")
     defaults.extensions = {
             "markdown.extensions.extra",
@@ -168,30 +448,164 @@ def init(opts):
             "markdown.extensions.sane_lists",
             }
 
+    defaults.numba_filters = []
+
     defaults.dirs = types.SimpleNamespace()
     defaults.dirs.content = "content"
     defaults.dirs.output = "output"
     defaults.dirs.assets = {"assets"}
+    defaults.dirs.cache = ".vsg-cache"
 
     sys.modules["vsg.defaults"] = sys.modules["defaults"] = defaults
     import config
     del sys.modules["vsg.defaults"], sys.modules["defaults"]
 
-    markdown_translator = markdown.Markdown(extensions=config.extensions)
+    return config
+
+def _init_worker(extensions):
+    # Filters are sent to workers by reference to the config module, so
+    # workers that weren't forked from vsg (eg. on Windows and macOS) need
+    # to load it the same way
+    _load_config()
+
+    # Pages are sent with just the extensions' key, so register the Markdown
+    # instance it refers to. Forked workers already have it.
+    _translator(extensions)
+
+def init(opts):
+    global config, template, markdown_translator, executor
+
+    sys.path.insert(0, "") # Allow importing from the current directory
+
+    import template # Yes, cinje is just that awesome
+
+    config = _load_config()
+
+    extensions = tuple(config.extensions)
+    markdown_translator = _translator(extensions)
+
+    # The worker processes live as long as vsg does, so their Markdown
+    # instances are reused across rebuilds in watch mode
+    executor = ProcessPoolExecutor(os.cpu_count(),
+            initializer=_init_worker, initargs=(extensions,))
+
+def _within(fn, d):
+    fn, d = path.abspath(fn), path.abspath(d)
+    return fn == d or fn.startswith(d + os.sep)
 
 class VsgRebuildEventHandler(FileSystemEventHandler):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, delay=0.1, **kwargs):
         super(VsgRebuildEventHandler, self).__init__(*args, **kwargs)
-        self.last_build_time = 0 # For debouncing
+        self.delay = delay
+        self._timer = None # For debouncing
+        self._events = []
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
 
-    def on_any_event(self, evt):
-        # Debounce code (watchdog is a little overzealous in its event reporting)
-        if self.last_build_time < time.time() - 2:
-            self.last_build_time = time.time()
+    def is_relevant(self, fn, is_directory=False):
+        name = path.basename(fn)
+        if (name.endswith("~") or name.startswith(".#")
+                or name.startswith(".") and name.endswith((".swp", ".swx"))):
+            return False # Editor swap/lock/backup files
+
+        if _within(fn, config.dirs.content):
+            # Don't check the filesystem: deleted or moved directories
+            # won't be there anymore
+            return not name.startswith(".") and (is_directory or name.endswith(".md"))
+
+        assets = config.dirs.assets
+        if isinstance(assets, str):
+            assets = {assets}
+
+        return any(_within(fn, a) for a in assets)
 
+    def on_any_event(self, evt):
+        # Newer versions of watchdog also report files being opened and
+        # closed, which the build itself does plenty of
+        if evt.event_type not in {"created", "deleted", "modified", "moved"}:
+            return
+
+        # Directories are reported as modified whenever their contents
+        # change, which is covered by the events for the contents
+        if evt.is_directory and evt.event_type == "modified":
+            return
+
+        fns = [evt.src_path, getattr(evt, "dest_path", "")]
+        if not any(fn and self.is_relevant(fn, evt.is_directory) for fn in fns):
+            return
+
+        # watchdog is a little overzealous in its event reporting, so wait
+        # until things have been quiet for a moment before rebuilding
+        with self._lock:
+            self._events.append(evt)
+            if self._timer:
+                self._timer.cancel()
+
+            self._timer = threading.Timer(self.delay, self._do_build)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _do_build(self):
+        with self._lock:
+            events, self._events = self._events, []
+
+        with self._build_lock:
             print("Rebuilding...")
+            self.rebuild(events)
+
+    def rebuild(self, events):
+        pages = getattr(config, "_page_by_src", {})
+        changed = set()
+        assets_changed = False
+        full = not pages # Nothing has been built yet
+
+        for evt in events:
+            if evt.is_directory:
+                # Directories are reported as modified whenever their
+                # contents change, which is handled by the other events
+                if evt.event_type != "modified":
+                    full = True
+                continue
+
+            src = path.abspath(evt.src_path)
+            dest = path.abspath(getattr(evt, "dest_path", "") or src)
+            if not _within(src, config.dirs.content) and not _within(dest, config.dirs.content):
+                assets_changed = True
+            elif evt.event_type == "modified" and src in pages:
+                changed.add(pages[src])
+            elif evt.event_type == "moved" and src not in pages and dest in pages:
+                # Some editors save by moving a temporary file over the original
+                changed.add(pages[dest])
+            else:
+                # Pages have been added, removed or renamed
+                full = True
+
+        if full:
             config.pages = list(read_pages())
             build()
+            return
+
+        if assets_changed:
+            copy_assets()
+
+        meta_changed = False
+        rerender = set()
+        for page in changed:
+            meta = page._meta
+            reload_page(page)
+            meta_changed = meta_changed or page._meta != meta
+
+            rerender.add(page)
+            if page.parent:
+                rerender.add(page.parent)
+
+        if meta_changed:
+            # Any page could be using the metadata (eg. for navigation)
+            save_pages(config.pages)
+            return
+
+        for page in rerender:
+            save_page(page)
 
 def start_watching(root="."):
     handler = VsgRebuildEventHandler()
@@ -201,6 +615,12 @@ def start_watching(root="."):
     return observer
 
 def main(opts):
+    if opts["clean"]:
+        # Only the configuration is needed to find the cache
+        sys.path.insert(0, "") # Allow importing from the current directory
+        clean(_load_config().dirs.cache)
+        return
+
     init(opts)
     if opts["watch"]:
         observer = start_watching()